@@ -1,14 +1,19 @@
 from collections import namedtuple
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from functools import lru_cache
 from string import ascii_letters, punctuation
 from unittest import mock, TestCase
-from xml.sax.saxutils import escape
+import copy
 import html
 import io
 import json
+import mmap
 import os
 import random
+import shutil
 import textwrap
 import unittest
+import urllib.request
 
 from hypothesis import example, given, Phase, settings
 from hypothesis import strategies as st
@@ -20,43 +25,126 @@ from xml_to_json import (
     XMLtoJSON,
 )
 
+# Hypothesis profiles: "ci" (default) runs fewer, derandomized examples and
+# skips the explain phase; "dev" keeps Hypothesis' default example count and
+# random generation for deeper local runs. Select with the HYPOTHESIS_PROFILE
+# environment variable. Derandomized runs do not use the example database, so
+# the reuse phase is left out of "ci".
+settings.register_profile(
+    'ci',
+    max_examples=25,
+    phases=(Phase.explicit, Phase.generate, Phase.shrink),
+    deadline=None,
+    derandomize=True)
+settings.register_profile('dev', max_examples=100, deadline=None)
+settings.load_profile(os.environ.get('HYPOTHESIS_PROFILE', 'ci'))
+
 # Data and cache directory for HAREM XML files
 HAREM_DATA_DIR = os.environ.get('HAREM_DATA_DIR')
 
-TOTAL_SCENARIO_CATEGS_ONLY = list(set(ALL_CATEGS) - set(SELECTIVE_CATEGS))
+# Sorted so that example generation order is stable across runs
+TOTAL_SCENARIO_CATEGS_ONLY = tuple(sorted(set(ALL_CATEGS) - set(SELECTIVE_CATEGS)))
+
+# Buffer size used to stream downloads to their destination
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 download_urls = {
     'FirstHAREM': 'https://www.linguateca.pt/aval_conjunta/HAREM/CDPrimeiroHAREMprimeiroevento.xml',
     'MiniHAREM': 'https://www.linguateca.pt/aval_conjunta/HAREM/CDPrimeiroHAREMMiniHAREM.xml',
 }
 
+def _cache_path(url, cache_dir):
+    """Path of the cached copy of `url` inside `cache_dir`."""
+    filename = url.split('/')[-1]
+    return os.path.join(cache_dir, filename)
+
+
+def _is_cached(target_path):
+    """Whether `target_path` holds a previously downloaded, non-empty file."""
+    return os.path.isfile(target_path) and os.path.getsize(target_path) > 0
+
+
 def cached_download(url, cache_dir=None):
     """Downloads data from `url` and saves the data into `cache_dir`, if it is
     not None. If `cache_dir` is specified and filename inferred from url exists
-    at the location, uses the cached version."""
-    import requests
-    
-    if cache_dir is not None:
-        filename = url.split('/')[-1]
-        target_path = os.path.join(cache_dir, filename)
+    at the location, uses the cached version. Returns a seekable read-only
+    file: a memory map of the cached file if `cache_dir` is specified,
+    otherwise an in-memory buffer."""
+    if cache_dir is None:
+        # urlopen raises HTTPError on error status codes
+        with urllib.request.urlopen(url, timeout=30) as response:
+            buffer = io.BytesIO()
+            shutil.copyfileobj(response, buffer, length=DOWNLOAD_CHUNK_SIZE)
+        buffer.seek(0)
+        return buffer
+
+    target_path = _cache_path(url, cache_dir)
+    if not _is_cached(target_path):
         os.makedirs(cache_dir, exist_ok=True)
-
-        if os.path.isfile(target_path):
-            return open(target_path, 'rb')
-    
-    # Download and save
-    response = requests.get(url, timeout=30)
-    response.raise_for_status()
-
-    if cache_dir is not None:
-        fd = open(target_path, 'wb+')
-        fd.write(response.content)
-        fd.seek(0)
-        return fd
-
-    response_bytes = io.BytesIO(response.content)
-    
-    return response_bytes
+        # Write to a temporary file first so an interrupted download does not
+        # leave a truncated file in the cache
+        tmp_path = target_path + '.part'
+        with urllib.request.urlopen(url, timeout=30) as response, \
+                open(tmp_path, 'wb') as fd:
+            shutil.copyfileobj(response, fd, length=DOWNLOAD_CHUNK_SIZE)
+        os.replace(tmp_path, target_path)
+
+    with open(target_path, 'rb') as fd:
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _is_valid_entity(entity, doc_text):
+    """Checks that the entity offsets are inside `doc_text` and that they
+    delimit the entity text."""
+    start, end = entity['start_offset'], entity['end_offset']
+    return 0 <= start < end <= len(doc_text) \
+        and doc_text[start:end] == entity['text']
+
+
+def _convert_and_validate(xml_path):
+    """Converts the XML file at `xml_path` in both scenarios and checks that
+    all documents have texts and all entities have valid texts and offsets.
+    Returns a dict mapping each scenario to the number of converted documents
+    and a list describing the invalid ones.
+
+    The file is parsed once and the tree is reused for both scenarios. The
+    total scenario is also converted with `XMLtoJSON.convert_xml`, whose output
+    must be the same. Defined at module level so it can run in a worker
+    process."""
+    # Memory-map the file so the parser reads straight from the page cache
+    with open(xml_path, 'rb') as fd, \
+            mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as xml_file:
+        tree = etree.parse(
+            xml_file, etree.XMLParser(collect_ids=False, huge_tree=True))
+    # DOC tags are collected once, as both scenarios iterate them
+    docs = list(tree.iter('DOC'))
+
+    results = {}
+    for scenario in ('selective', 'total'):
+        converted = XMLtoJSON.convert_tree(
+            docs, selective=scenario == 'selective')
+        errors = []
+
+        for doc in converted:
+            doc_text = doc['doc_text']
+
+            if not doc_text:
+                errors.append((doc['doc_id'], 'Text should not be empty'))
+
+            errors.extend((doc['doc_id'], i, entity)
+                          for i, entity in enumerate(doc['entities'])
+                          if not _is_valid_entity(entity, doc_text))
+
+        if scenario == 'total':
+            # The CLI goes through `convert_xml`, which streams the file
+            # instead of reusing the parsed tree. It must match as well.
+            if XMLtoJSON.convert_xml(xml_path) != converted:
+                errors.append(('convert_xml',
+                               'Output differs from convert_tree'))
+
+        results[scenario] = (len(converted), errors)
+
+    return results
 
 
 # Text generation Hypothesis strategies
@@ -70,20 +158,144 @@ def left_pad_space(text):
 # Strategies that generate XML escaped text, with and without
 # spaces 
 vocabulary = ascii_letters + punctuation + '\n '
-st_escaped_text = st.builds(escape, st.text(vocabulary, min_size=4))
+_ALPHABET = st.sampled_from(tuple(vocabulary))
+_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+
+def escape(text):
+    """Escapes &, < and > like `xml.sax.saxutils.escape`, in a single
+    `str.translate` pass."""
+    return text.translate(_ESCAPE_TABLE)
+
 
-st_left_padded_text = st.builds(left_pad_space, st_escaped_text)
-st_lstripped_text = st.builds(str.lstrip, st_escaped_text)
-st_stripped_text = st.builds(str.strip, st_escaped_text)
+st_escaped_text = st.text(_ALPHABET, min_size=4, max_size=32).map(escape)
+
+st_left_padded_text = st_escaped_text.map(left_pad_space)
+st_lstripped_text = st_escaped_text.map(str.lstrip)
+st_stripped_text = st_escaped_text.map(str.strip)
+
+# Label strategies
+st_total_only_label = st.sampled_from(TOTAL_SCENARIO_CATEGS_ONLY)
+st_selective_label = st.sampled_from(SELECTIVE_CATEGS)
+st_label = st.sampled_from(ALL_CATEGS)
+
+
+@lru_cache(maxsize=None)
+def _parse_cached(tag_text_with_tail: str) -> etree._Element:
+    """Parse `tag_text_with_tail` wrapped in a <WRAP> tag. Results are cached,
+    so callers must not modify the returned tree."""
+    return etree.fromstring(f"<WRAP>{tag_text_with_tail}</WRAP>")
 
 
 def create_tag(tag_text_with_tail: str):
     """Create a XML tag from string. Allows for tail text after the tag by
-    wrapping the tag in another tag in creation."""
-    wrapped_tag = f"<WRAP>{tag_text_with_tail}</WRAP>"
-    tag = etree.fromstring(wrapped_tag)
-    
-    return next(iter(tag))
+    wrapping the tag in another tag in creation.
+
+    Parsed trees are cached by source string and each call returns a fresh
+    copy, since lxml elements are mutable and linked to their parents."""
+    tag = next(iter(_parse_cached(tag_text_with_tail)))
+
+    return copy.deepcopy(tag)
+
+
+@lru_cache(maxsize=1024)
+def _expected_entity_text(entity_text):
+    """Text expected from an <EM> tag whose escaped content is `entity_text`.
+    Skips `html.unescape` when there is no character reference to resolve."""
+    text = entity_text.lstrip()
+    return html.unescape(text) if '&' in text else text
+
+
+def _norm_entities(entities):
+    """Sorted tuples of entity fields, for order-insensitive comparison of
+    entity lists without `assertCountEqual`'s quadratic fallback for
+    unhashable dicts."""
+    return tuple(sorted(
+        (ent['entity_id'], ent['label'], ent['text'], ent['start_offset'],
+         ent['end_offset'])
+        for ent in entities))
+
+
+# Constant inputs and expected outputs shared by the tests, built once
+
+_Entity = namedtuple('_Entity', ['label', 'text'])
+
+ALT_TAG_TEXT = (
+    '<ALT><EM ID="142" CATEG="ACONTECIMENTO" TIPO="EVENTO">'
+    'Ovarense-Amora</EM>|'
+    '<EM ID="143" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Ovarense</EM>'
+    '-<EM ID="144" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Amora</EM></ALT>')
+
+# All entities of ALT_TAG_TEXT, with offsets relative to the whole ALT text
+_ALT_TAG_ENTITIES = (
+    {'entity_id': '142',
+     'text': 'Ovarense-Amora',
+     'start_offset': 0,
+     'end_offset': len('Ovarense-Amora'),
+     'label': 'ACONTECIMENTO'},
+    {'entity_id': '143',
+     'text': 'Ovarense',
+     'start_offset': len('Ovarense-Amora|'),
+     'end_offset': len('Ovarense-Amora|Ovarense'),
+     'label': 'PESSOA'},
+    {'entity_id': '144',
+     'text': 'Amora',
+     'start_offset': len('Ovarense-Amora|Ovarense-'),
+     'end_offset': len('Ovarense-Amora|Ovarense-Amora'),
+     'label': 'PESSOA'},
+)
+EXPECTED_ALT_TAG_ENTITIES = _norm_entities(_ALT_TAG_ENTITIES)
+EXPECTED_ALT_TAG_SELECTIVE_ENTITIES = _norm_entities(_ALT_TAG_ENTITIES[1:])
+
+# Entities of each alternative of ALT_TAG_TEXT, with offsets relative to the
+# alternative text
+EXPECTED_FIRST_ALTERNATIVE_ENTS = _norm_entities([
+    {'entity_id': '142',
+     'text': 'Ovarense-Amora',
+     'start_offset': 0,
+     'end_offset': len('Ovarense-Amora'),
+     'label': 'ACONTECIMENTO'},
+])
+EXPECTED_SECOND_ALTERNATIVE_ENTS = _norm_entities([
+    {'entity_id': '143',
+     'text': 'Ovarense',
+     'start_offset': 0,
+     'end_offset': len('Ovarense'),
+     'label': 'PESSOA'},
+    {'entity_id': '144',
+     'text': 'Amora',
+     'start_offset': len('Ovarense-'),
+     'end_offset': len('Ovarense-Amora'),
+     'label': 'PESSOA'},
+])
+
+# A small HAREM-like collection with several documents
+SMALL_COLLECTION_XML = (
+    '<colHAREM>'
+    + ''.join(
+        f'<DOC DOCID="HAREM-{i}">O <EM ID="{i}1" CATEG="PESSOA">Rui</EM> '
+        f'foi a <EM ID="{i}2" CATEG="LOCAL">Lisboa</EM> em '
+        f'<EM ID="{i}3" CATEG="TEMPO">{1900 + i}</EM>'
+        f'<EM ID="{i}4" CATEG="OBRA">Matrix</EM>.</DOC>'
+        for i in range(50))
+    + '</colHAREM>').encode('utf-8')
+
+EXPECTED_DOC_CONVERSION_ENTITIES = (
+    _Entity('PESSOA', 'Clive Cussler'),
+    _Entity('PESSOA', 'Dirk Pitt'),
+    _Entity('VALOR', 'US$ 14 milhões'),
+    _Entity('ORGANIZACAO', 'Simon & Schuster'),
+)
+
+EXPECTED_AGGLUTINATION_ENTITIES = (
+    _Entity('PESSOA', 'Marco Bode'),
+    _Entity('VALOR', '4-0'),
+    _Entity('VALOR', "67'"),
+    _Entity('PESSOA', 'Duisburg'),
+    _Entity('PESSOA', 'Markkus Marin'),
+    _Entity('VALOR', "78'"),
+    _Entity('PESSOA', 'Andreas Herzog'),
+)
 
 
 class MetaTest(TestCase):
@@ -115,8 +327,23 @@ class XMLtoJSONTest(TestCase):
     strategies, such as selecting an entity label from a set of possible values
     and text."""
 
-    @given(st.sampled_from(TOTAL_SCENARIO_CATEGS_ONLY),
-           st.sampled_from(SELECTIVE_CATEGS))
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Converters hold no per-document state, so they are shared by all
+        # tests and Hypothesis examples
+        cls.converters = {
+            (selective, alt_strategy): XMLtoJSON(selective=selective,
+                                                 alt_strategy=alt_strategy)
+            for selective in (True, False)
+            for alt_strategy in ('most_entities', 'entity_coverage')
+        }
+        cls.conv_sel_me = cls.converters[True, 'most_entities']
+        cls.conv_tot_me = cls.converters[False, 'most_entities']
+        cls.conv_sel_ec = cls.converters[True, 'entity_coverage']
+        cls.conv_tot_ec = cls.converters[False, 'entity_coverage']
+
+    @given(st_total_only_label, st_selective_label)
     @example('ABSTRACCAO', 'PESSOA')
     def test_get_label_vague_entity_valid_label(
             self, total_only_label, selective_label):
@@ -128,61 +355,59 @@ class XMLtoJSONTest(TestCase):
         tag_text = f'<EM ID="383" CATEG="{total_only_label}|{selective_label}"></EM>'
         tag = create_tag(tag_text)
 
-        label = XMLtoJSON(selective=True)._get_label(tag)
+        label = self.conv_sel_me._get_label(tag)
         self.assertEqual(
             label, selective_label,
             "Selective scenario should ignore first label.")
 
-        label = XMLtoJSON(selective=False)._get_label(tag)
+        label = self.conv_tot_me._get_label(tag)
         self.assertEqual(
             label, total_only_label,
             "Total scenario should always return first label.")
 
-    @given(st.sampled_from(TOTAL_SCENARIO_CATEGS_ONLY),
-           st.sampled_from(TOTAL_SCENARIO_CATEGS_ONLY))
+    @given(st_total_only_label, st_total_only_label)
     @example('ABSTRACCAO', 'COISA')
     def test_get_label_vague_single_label_total_only(
             self, total_only_label_1, total_only_label_2):
         tag_text = f'<EM ID="383" CATEG="{total_only_label_1}|{total_only_label_2}"></EM>'
         tag = create_tag(tag_text)
 
-        label = XMLtoJSON(selective=True)._get_label(tag)
+        label = self.conv_sel_me._get_label(tag)
         self.assertIsNone(label, "Selective scenario should ignore the label.")
 
-        label = XMLtoJSON(selective=False)._get_label(tag)
+        label = self.conv_tot_me._get_label(tag)
         self.assertEqual(label, total_only_label_1,
             "Total scenario should read the first label.")
 
 
-    @given(st.sampled_from(SELECTIVE_CATEGS))
+    @given(st_selective_label)
     def test_get_label_selective_scenario(self, input_label):
         """Test that labels from selective scenario are always considered in
         both scenarios."""
         tag_text = f'<EM ID="383" CATEG="{input_label}"></EM>'
         tag = create_tag(tag_text)
 
-        label = XMLtoJSON(selective=True)._get_label(tag)
+        label = self.conv_sel_me._get_label(tag)
         self.assertEqual(label, input_label,
             "Selective scenario should read the label.")
 
-        label = XMLtoJSON(selective=False)._get_label(tag)
+        label = self.conv_tot_me._get_label(tag)
         self.assertEqual(label, input_label,
             "Total scenario should read the label.")
 
 
-    @given(st.integers(min_value=1),
-           st.sampled_from(ALL_CATEGS),
-           st.text(alphabet=st_stripped_text, min_size=4))
+    @given(st.from_regex(r'[1-9][0-9]{0,4}', fullmatch=True),
+           st_label,
+           st_stripped_text.filter(lambda text: len(text) >= 4))
     @example('380', 'ORGANIZACAO', 'Leonardo da Vinci')
     @example('1994', 'COISA', 'SuperEmail Marketing v3.01')
     def test_convert_entity(self, entity_id, label, entity_text):
         """Tests the conversion of <EM/> tag to a dictionary."""
-        entity_id = str(entity_id)
         tag_text = f'<EM ID="{entity_id}" CATEG="{label}">{entity_text}</EM>'
         em_tag = create_tag(tag_text)
 
-        entity_dict = XMLtoJSON(selective=False)._convert_entity(em_tag)
-        processed_text = html.unescape(entity_text.lstrip())
+        entity_dict = self.conv_tot_me._convert_entity(em_tag)
+        processed_text = _expected_entity_text(entity_text)
 
         self.assertDictEqual(
             entity_dict,
@@ -198,118 +423,82 @@ class XMLtoJSONTest(TestCase):
     def test_iterate_alt_tag(self):
         """Test `_iterate_alt_tag` method outputs for an example tag in both
         scenarios."""
-        alt_tag_text = (
-            '<ALT><EM ID="142" CATEG="ACONTECIMENTO" TIPO="EVENTO">'
-            'Ovarense-Amora</EM>|'
-            '<EM ID="143" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Ovarense</EM>'
-            '-<EM ID="144" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Amora</EM></ALT>')
-        alt_tag = create_tag(alt_tag_text)
+        alt_tag = create_tag(ALT_TAG_TEXT)
 
         with self.subTest("Test _iterate_alt_tag in Total scenario"):
-            text, entities = XMLtoJSON(selective=False)._iterate_alt_tag(
-                alt_tag)
+            text, entities = self.conv_tot_me._iterate_alt_tag(alt_tag)
 
             self.assertEqual(
                 text,
                 "Ovarense-Amora|Ovarense-Amora"
             )
-
-            entities_in_alt_tag = [
-                {'entity_id': '142',
-                 'text': 'Ovarense-Amora',
-                 'start_offset': 0,
-                 'end_offset': len('Ovarense-Amora'),
-                 'label': 'ACONTECIMENTO'},
-                {'entity_id': '143',
-                 'text': 'Ovarense',
-                 'start_offset': len('Ovarense-Amora|'),
-                 'end_offset': len('Ovarense-Amora|Ovarense'),
-                 'label': 'PESSOA'},
-                {'entity_id': '144',
-                 'text': 'Amora',
-                 'start_offset': len('Ovarense-Amora|Ovarense-'),
-                 'end_offset': len('Ovarense-Amora|Ovarense-Amora'),
-                 'label': 'PESSOA'}
-            ]
-            self.assertCountEqual(
-                entities,
-                entities_in_alt_tag,
+            self.assertEqual(
+                _norm_entities(entities),
+                EXPECTED_ALT_TAG_ENTITIES,
             )
 
         with self.subTest("Test _iterate_alt_tag in Selective scenario"):
-            text, entities = XMLtoJSON(selective=True)._iterate_alt_tag(
-                alt_tag)
+            text, entities = self.conv_sel_me._iterate_alt_tag(alt_tag)
 
             self.assertEqual(
                 text,
                 "Ovarense-Amora|Ovarense-Amora"
             )
 
-            self.assertCountEqual(
-                entities,
-                entities_in_alt_tag[1:],
+            self.assertEqual(
+                _norm_entities(entities),
+                EXPECTED_ALT_TAG_SELECTIVE_ENTITIES,
                 "Selective scenario should ignore the first 'ACONTECIMENTO'"
                 "entity."
             )
 
 
+    def test_iterate_alt_tag_agglutination_correction(self):
+        """Test that the space inserted to avoid agglutination before an <EM>
+        tag inside ALT is not counted in the entity offsets."""
+        alt_tag = create_tag(
+            '<ALT>foi em<EM ID="1" CATEG="LOCAL">Lisboa</EM>|'
+            'foi a Lisboa</ALT>')
+
+        text, entities = self.conv_tot_me._iterate_alt_tag(alt_tag)
+
+        self.assertEqual(text, 'foi em Lisboa|foi a Lisboa')
+        self.assertEqual(len(entities), 1)
+        start, end = entities[0]['start_offset'], entities[0]['end_offset']
+        self.assertEqual(text[start:end], 'Lisboa')
+
+
     def test_handle_alt_method(self):
         """Tests `_handle_alt` method for a real ALT tag. Asserts the extracted
         text and entities respect the alt_strategy and scenario."""
-        alt_tag_text = (
-            '<ALT><EM ID="142" CATEG="ACONTECIMENTO" TIPO="EVENTO">'
-            'Ovarense-Amora</EM>|'
-            '<EM ID="143" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Ovarense</EM>'
-            '-<EM ID="144" CATEG="PESSOA" TIPO="GRUPOMEMBRO">Amora</EM></ALT>')
-        alt_tag = create_tag(alt_tag_text)
-
-        first_alternative_ents = [
-            {'entity_id': '142',
-             'text': 'Ovarense-Amora',
-             'start_offset': 0,
-             'end_offset': len('Ovarense-Amora'),
-             'label': 'ACONTECIMENTO'}
-        ]
-
-        second_alternative_ents = [
-            {'entity_id': '143',
-             'text': 'Ovarense',
-             'start_offset': 0,
-             'end_offset': len('Ovarense'),
-             'label': 'PESSOA'},
-            {'entity_id': '144',
-             'text': 'Amora',
-             'start_offset': len('Ovarense-'),
-             'end_offset': len('Ovarense-Amora'),
-             'label': 'PESSOA'},
-        ]
+        alt_tag = create_tag(ALT_TAG_TEXT)
 
         with self.subTest("Test _handle_alt in Total scenario with "
                           "most_entities strategy"):
-            converter = XMLtoJSON(selective=False, alt_strategy='most_entities')
+            converter = self.conv_tot_me
             text, entities = converter._handle_alt(alt_tag)
 
             self.assertEqual(
                 text,
                 "Ovarense-Amora"
             )
-            self.assertCountEqual(
-                entities,
-                second_alternative_ents,
+            self.assertEqual(
+                _norm_entities(entities),
+                EXPECTED_SECOND_ALTERNATIVE_ENTS,
             )
 
         with self.subTest("Test _handle_alt in Total scenario with "
                           "entity_coverage strategy"):
-            converter = XMLtoJSON(selective=False, alt_strategy='entity_coverage')
+            converter = self.conv_tot_ec
             text, entities = converter._handle_alt(alt_tag)
 
             self.assertEqual(
                 text,
                 "Ovarense-Amora"
             )
-            self.assertCountEqual(
-                entities,
-                first_alternative_ents,
+            self.assertEqual(
+                _norm_entities(entities),
+                EXPECTED_FIRST_ALTERNATIVE_ENTS,
             )
 
         # For selective scenario, only the second alternative has entities, so
@@ -317,19 +506,45 @@ class XMLtoJSONTest(TestCase):
         for alt_strategy in ('most_entities', 'entity_coverage'):
             with self.subTest("Test _handle_alt in Selective scenario with "
                               f"{alt_strategy} strategy"):
-                converter = XMLtoJSON(selective=True, alt_strategy=alt_strategy)
+                converter = self.converters[True, alt_strategy]
                 text, entities = converter._handle_alt(alt_tag)
 
                 self.assertEqual(
                     text,
                     "Ovarense-Amora"
                 )
-                self.assertCountEqual(
-                    entities,
-                    second_alternative_ents,
+                self.assertEqual(
+                    _norm_entities(entities),
+                    EXPECTED_SECOND_ALTERNATIVE_ENTS,
                 )
 
 
+    def test_split_alternatives_with_empty_alternative(self):
+        """Test that entities are assigned to the right alternative when an
+        alternative in between has no entities."""
+        alt_text = 'Rui|Rui Costa|Rui Costa'
+        entities = [
+            {'entity_id': '1', 'text': 'Rui', 'label': 'PESSOA',
+             'start_offset': 0, 'end_offset': 3},
+            {'entity_id': '2', 'text': 'Rui Costa', 'label': 'PESSOA',
+             'start_offset': 14, 'end_offset': 23},
+        ]
+
+        alt_texts, groups = self.conv_tot_me._split_alternatives(
+            alt_text, entities)
+
+        self.assertListEqual(alt_texts, ['Rui', 'Rui Costa', 'Rui Costa'])
+        self.assertListEqual(
+            groups,
+            [
+                [{'entity_id': '1', 'text': 'Rui', 'label': 'PESSOA',
+                  'start_offset': 0, 'end_offset': 3}],
+                [],
+                [{'entity_id': '2', 'text': 'Rui Costa', 'label': 'PESSOA',
+                  'start_offset': 0, 'end_offset': 9}],
+            ])
+
+
     def test_handle_alt_simple_case(self):
         """Test ALT tag handling for the two strategies when only one
         alternative has entities."""
@@ -340,8 +555,7 @@ class XMLtoJSONTest(TestCase):
         for alt_strat in ['most_entities', 'entity_coverage']:
             with self.subTest(
                     msg=f"Test Total scenario with strategy {alt_strat}"):
-                converter = XMLtoJSON(selective=False,
-                                      alt_strategy=alt_strat)
+                converter = self.converters[False, alt_strat]
 
                 chosen_text, chosen_entities = converter._handle_alt(alt_tag)
                 self.assertEqual(chosen_text, "Nomes de Origem")
@@ -358,7 +572,7 @@ class XMLtoJSONTest(TestCase):
         for alt_strat in ['most_entities', 'entity_coverage']:
             with self.subTest(
                     msg=f"Test Selective scenario with strategy {alt_strat}"):
-                converter = XMLtoJSON(selective=True, alt_strategy=alt_strat)
+                converter = self.converters[True, alt_strat]
 
                 chosen_text, chosen_entities = converter._handle_alt(alt_tag)
                 self.assertEqual(chosen_text, "Nomes de Origem")
@@ -384,15 +598,7 @@ class XMLtoJSONTest(TestCase):
             'assinou um contrato de US$ 14 milhões com a Simon & Schuster para a publicação '
             'de dois livros.')
 
-        _Entity = namedtuple('_Entity', ['label', 'text'])
-        expected_entities = [
-            _Entity('PESSOA', 'Clive Cussler'),
-            _Entity('PESSOA', 'Dirk Pitt'),
-            _Entity('VALOR', 'US$ 14 milhões'),
-            _Entity('ORGANIZACAO', 'Simon & Schuster'),
-        ]
-
-        doc_dict = XMLtoJSON(selective=False).convert_document(doc_tag)
+        doc_dict = self.conv_tot_me.convert_document(doc_tag)
 
         self.assertEqual(doc_dict['doc_id'], doc_tag.attrib['DOCID'])
         self.assertEqual(
@@ -402,8 +608,8 @@ class XMLtoJSONTest(TestCase):
 
         with self.subTest('Test entities start and end offsets match the'
                           ' entity text.'):
-            for entity, expected_entity in zip(doc_dict['entities'],
-                                               expected_entities):
+            for entity, expected_entity in zip(
+                    doc_dict['entities'], EXPECTED_DOC_CONVERSION_ENTITIES):
                 start, end = entity['start_offset'], entity['end_offset']
                 self.assertEqual(
                     doc_dict['doc_text'][start:end],
@@ -430,24 +636,13 @@ class XMLtoJSONTest(TestCase):
             '78\'</EM>) e foi <EM ID="209" CATEG="PESSOA" TIPO="INDIVIDUAL">'
             'Andreas Herzog</EM> quem estabeleceu o resultado final, a sete '
             'minutos do fim.</DOC>')
-        doc_tag = etree.fromstring(doc_excerpt)
-        doc_dict = XMLtoJSON(selective=False).convert_document(doc_tag)
+        doc_tag = create_tag(doc_excerpt)
+        doc_dict = self.conv_tot_me.convert_document(doc_tag)
 
         doc_text = ("Marco Bode fez o 4-0 aos 67', o Duisburg reduziu por "
             "Markkus Marin (78') e foi Andreas Herzog quem estabeleceu o "
             "resultado final, a sete minutos do fim.")
 
-        _Entity = namedtuple('_Entity', ['label', 'text'])
-        expected_entities = [
-            _Entity('PESSOA', 'Marco Bode'),
-            _Entity('VALOR', '4-0'),
-            _Entity('VALOR', "67'"),
-            _Entity('PESSOA', 'Duisburg'),
-            _Entity('PESSOA', 'Markkus Marin'),
-            _Entity('VALOR', "78'"),
-            _Entity('PESSOA', 'Andreas Herzog'),
-        ]
-
         self.assertEqual(
             doc_dict['doc_text'],
             doc_text,
@@ -455,7 +650,7 @@ class XMLtoJSONTest(TestCase):
             "before <EM> tag.")
 
         for entity, expected_entity in zip(doc_dict['entities'],
-                                           expected_entities):
+                                           EXPECTED_AGGLUTINATION_ENTITIES):
             start, end = entity['start_offset'], entity['end_offset']
             self.assertEqual(
                 entity['text'],
@@ -470,6 +665,31 @@ class XMLtoJSONTest(TestCase):
             self.assertEqual(entity['label'], expected_entity.label)
 
 
+    def test_convert_xml_stream(self):
+        """Test that streaming conversion yields the same documents as
+        converting the fully parsed tree."""
+        xml = SMALL_COLLECTION_XML
+
+        for selective in (True, False):
+            with self.subTest(selective=selective):
+                streamed = XMLtoJSON.convert_xml_stream(
+                    io.BytesIO(xml), selective=selective)
+                expected = XMLtoJSON.convert_tree(
+                    etree.fromstring(xml).iter('DOC'), selective=selective)
+
+                self.assertListEqual(list(streamed), expected)
+
+
+    def test_convert_xml_num_workers(self):
+        """Test that converting with a process pool yields the same documents,
+        in the same order, as converting in a single process."""
+        expected = XMLtoJSON.convert_xml(io.BytesIO(SMALL_COLLECTION_XML))
+        converted = XMLtoJSON.convert_xml(io.BytesIO(SMALL_COLLECTION_XML),
+                                          num_workers=2)
+
+        self.assertListEqual(converted, expected)
+
+
     @unittest.skipIf(HAREM_DATA_DIR is None,
                      "Environment variable HAREM_DATA_DIR must be set to run "
                      "this test.")
@@ -480,40 +700,35 @@ class XMLtoJSONTest(TestCase):
         
         HAREM files will be downloaded and saved in the cache directory.
         """
-        files = {}
-
-        for dataset in ('FirstHAREM', 'MiniHAREM'):
-            xml_file = cached_download(download_urls[dataset],
-                                       cache_dir=HAREM_DATA_DIR)
-            files[dataset] = xml_file
-            
-            for scenario in ('selective', 'total'):
-                xml_file.seek(0)
-                converted = XMLtoJSON.convert_xml(
-                    xml_file, selective=scenario == 'selective')
-
-                self.assertEqual(
-                    len(converted),
-                    129 if dataset == 'FirstHAREM' else 128,
-                    "Assert converted document count is right."
-                )
-
-                for doc in converted:
-                    doc_text = doc['doc_text']
-
-                    self.assertGreater(
-                        len(doc_text),
-                        0,
-                        'Text should not be empty')
-
-                    for entity in doc['entities']:
-                        start, end = entity['start_offset'], entity['end_offset']
-                        self.assertTrue(0 <= start < end)
-                        self.assertTrue(0 < end <= len(doc_text))
-                        self.assertEqual(doc_text[start:end], entity['text'])
-
-        for fp in files.values():
-            fp.close()
+        expected_doc_count = {'FirstHAREM': 129, 'MiniHAREM': 128}
+
+        # Populate the cache up front so workers only read from disk
+        xml_paths = {}
+        for dataset in expected_doc_count:
+            url = download_urls[dataset]
+            cached_download(url, cache_dir=HAREM_DATA_DIR).close()
+            xml_paths[dataset] = _cache_path(url, HAREM_DATA_DIR)
+
+        # Datasets are independent and CPU-bound, so convert them in parallel
+        with ProcessPoolExecutor(max_workers=len(xml_paths)) as executor:
+            futures = {
+                executor.submit(_convert_and_validate, xml_path): dataset
+                for dataset, xml_path in xml_paths.items()
+            }
+
+            for future in as_completed(futures):
+                dataset = futures[future]
+
+                for scenario, (doc_count, errors) in future.result().items():
+                    with self.subTest(dataset=dataset, scenario=scenario):
+                        self.assertEqual(
+                            doc_count,
+                            expected_doc_count[dataset],
+                            "Assert converted document count is right.")
+                        self.assertFalse(
+                            errors,
+                            f"{len(errors)} invalid documents or entities, "
+                            f"e.g. {errors[:3]}")
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
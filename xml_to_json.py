@@ -1,6 +1,8 @@
-from typing import Dict, List, Tuple, Union
+from bisect import bisect_right
+from itertools import accumulate, islice
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 import logging
-import re
+import multiprocessing
 
 from lxml import etree
 
@@ -32,6 +34,36 @@ class HypothesisViolation(Exception):
     pass
 
 
+class _LazyDict:
+    """Wraps a mapping in a logging argument, so that it is only copied into
+    a dict when a handler actually formats the log record."""
+    __slots__ = ('_mapping',)
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def __str__(self) -> str:
+        return str(dict(self._mapping))
+
+    __repr__ = __str__
+
+
+class _CharTable(dict):
+    """Maps characters to `predicate(char)`, computing each entry on first
+    access. Lookups of already seen characters are plain dict subscripts."""
+
+    def __init__(self, predicate):
+        super().__init__()
+        self._predicate = predicate
+
+    def __missing__(self, char: str) -> bool:
+        value = self[char] = self._predicate(char)
+        return value
+
+
+_WHITESPACE_OR_PUNCTUATION = _CharTable(_is_whitespace_or_punctuation)
+
+
 class XMLtoJSON:
     """Converts First HAREM XML format to JSON.
     
@@ -48,58 +80,70 @@ class XMLtoJSON:
     def __init__(self,
                  selective: bool = False,
                  alt_strategy: str = 'most_entities'):
+        # Only used for membership tests, so a frozenset is enough
         if selective:
-            self._accepted_labels = SELECTIVE_CATEGS
+            self._accepted_labels = frozenset(SELECTIVE_CATEGS)
         else:
-            self._accepted_labels = ALL_CATEGS
+            self._accepted_labels = frozenset(ALL_CATEGS)
         
         strategies = ('most_entities', 'entity_coverage')
         if alt_strategy not in strategies:
             raise ValueError('`alt_strategy` must be one of {}'.format(strategies))
         self.alt_strategy = alt_strategy
 
+        # Handlers of the tags that hold text and entities, by tag name
+        self._tag_handlers = {
+            'EM': self._convert_em_tag,
+            'ALT': self._handle_alt,
+        }
 
-    @staticmethod
-    def _shift_offset(entity: ENTITY, group_offset: int) -> ENTITY:
-        """Shifts start_offset and end_offset by `group_offset` characters."""
-        entity['start_offset'] += group_offset
-        entity['end_offset'] += group_offset
-        return entity
-    
-    def _get_label(self, entity: etree._Element) -> Union[str, None]:
+
+    def _get_label(self,
+                   entity: etree._Element,
+                   attrib: Union[etree._Attrib, None] = None,
+                   ) -> Union[str, None]:
         """Gets the label of an entity considering the label scenario.
         In case of ambiguity, returns the first acceptable label or None
-        if there are no acceptable labels."""
-        categ = entity.attrib.get('CATEG')
+        if there are no acceptable labels. `attrib` can be given to reuse the
+        `entity.attrib` proxy of the caller."""
+        if attrib is None:
+            attrib = entity.attrib
+
+        categ = attrib.get('CATEG')
         if categ is None:
-            logger.debug('Could not find label of entity with attributes %s',
-                         dict(entity.attrib))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Could not find label of entity with attributes %s',
+                             _LazyDict(attrib))
             return None
         
-        labels = [label.strip() for label in categ.split('|')]
-        for label in labels:
+        for label in categ.split('|'):
+            label = label.strip()
             if label in self._accepted_labels:
                 return label
         
-        logger.debug('Ignoring <EM ID="%s" CATEG="%s">.',
-                     entity.attrib.get("ID"),
-                     categ)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Ignoring <EM ID="%s" CATEG="%s">.',
+                         attrib.get("ID"),
+                         categ)
         return None
     
     def _convert_entity(self, elem: etree._Element) -> ENTITY:
         """Convert an <EM/> tag into a dict with the relevant information
         considering the label scenario."""
-        entity_text = elem.text.lstrip()
-        if entity_text != elem.text:
+        attrib = elem.attrib
+        entity_id = attrib['ID']
+        raw_text = elem.text
+        entity_text = raw_text.lstrip()
+        if entity_text != raw_text and logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 'Left stripping spaces of <EM ID="%s">%s</EM>',
-                elem.attrib['ID'],
-                elem.text)
+                entity_id,
+                raw_text)
         
         return {
-            'entity_id': elem.attrib['ID'],
+            'entity_id': entity_id,
             'text': entity_text,
-            'label': self._get_label(elem),
+            'label': self._get_label(elem, attrib),
             'start_offset': 0,
             'end_offset': len(entity_text),
         }
@@ -109,22 +153,30 @@ class XMLtoJSON:
                         ) -> Tuple[str, List[ENTITY]]:
         """Iterate over an ALT tag and return the complete text and all
         entities inside it as if it was a single alternative."""
-        text = ''
+        # lxml builds a new string on each .text/.tail access, so they are
+        # read once
+        text = alt_tag.text or ''
         entities = []
-
-        if alt_tag.text:
-            text += alt_tag.text
         
-        for tag in alt_tag:
-            if tag.tag == 'EM':
-                entity = self._convert_entity(tag)
-                if entity['label'] is not None:
-                    self._shift_offset(entity, len(text))
-                    entities.append(entity)
-                text = self.append_text_safe(text, entity['text'])
+        for tag in alt_tag.iterchildren('EM'):
+            entity = self._convert_entity(tag)
+            entity_text = entity['text']
+
+            # Insert the separating space before computing the offset, so it
+            # is not counted as part of the entity
+            if self._agglutinates(text, entity_text):
+                text += ' '
 
-                if tag.tail:
-                    text = self.append_text_safe(text, tag.tail)
+            if entity['label'] is not None:
+                offset = len(text)
+                entity['start_offset'] += offset
+                entity['end_offset'] += offset
+                entities.append(entity)
+            text += entity_text
+
+            tail = tag.tail
+            if tail:
+                text = self.append_text_safe(text, tail)
 
         return text, entities
 
@@ -133,7 +185,8 @@ class XMLtoJSON:
                             alt_entities: List[ENTITY],
                             ) -> Tuple[List[str], List[List[ENTITY]]]:
         """Given the text of an ALT tag and all entities inside it, divide the
-        text and entities of the distinct alternatives inside ALT.
+        text and entities of the distinct alternatives inside ALT. Entity
+        offsets are shifted in place to be relative to their alternative.
         
         Example of ALT tag:
             <ALT>Nomes de Origem|<EM ID="2011" {...}>Nomes de Origem</EM></ALT>
@@ -165,37 +218,25 @@ class XMLtoJSON:
             raise HypothesisViolation(
                 "ALT tag must have at least 2 alternatives.")
         
-        # Find the char offset of all "|" chars
-        divs = [div.start() for div in re.finditer(r'\|', alt_text)]
-        
+        # Char offset where each alternative starts in `alt_text`
+        group_starts = [0]
+        group_starts.extend(accumulate(len(text) + 1 for text in alt_texts[:-1]))
+
         # Split entities into groups of the distinct alternatives.
         # One group will later be selected as the true labels.
-        groups = []
-        for _ in range(len(alt_texts)):
-            groups.append([])
-        
-        group_ix = 0
-        group_start_offset = 0
-        current_group_end = divs[0]
-        
-        for entity in alt_entities:
-            start = entity['start_offset']
-            
-            if start > current_group_end:
-                # Entity belongs to next alternative
-                group_ix += 1
-                group_start_offset = current_group_end + 1
+        groups = [[] for _ in alt_texts]
 
-                if group_ix < len(divs):
-                    current_group_end = divs[group_ix]
-                elif group_ix == len(divs):
-                    current_group_end = len(alt_text)
+        for entity in alt_entities:
+            group_ix = bisect_right(group_starts, entity['start_offset']) - 1
+            group_start_offset = group_starts[group_ix]
 
             # Shift entity to discard the offset due to the text of previous
-            # alternatives
-            entity = self._shift_offset(dict(entity), -group_start_offset)
+            # alternatives. Entities come fresh from `_iterate_alt_tag`, so
+            # they are shifted in place.
+            entity['start_offset'] -= group_start_offset
+            entity['end_offset'] -= group_start_offset
             groups[group_ix].append(entity)
-                
+
         assert len(groups) == len(alt_texts)
 
         return alt_texts, groups
@@ -215,90 +256,88 @@ class XMLtoJSON:
         if self.alt_strategy == 'most_entities':
             # Choose the first group that have the highest number of accepted
             # labels
-            ents_per_group = [len(group) for group in groups]
-            assert sum(ents_per_group) == len(entities)
-            N_max = ents_per_group.index(max(ents_per_group))
-            chosen_entities = groups[N_max]
-            group_text = alt_texts[N_max]
-            if sum(ents_per_group) != ents_per_group[N_max]:
-                # More than 2 groups with entities
-                not_chosen = groups[:]
-                not_chosen.remove(chosen_entities)
-                logger.debug(
-                    'Choosing ALT %s over alternatives %s', 
-                    chosen_entities,
-                    not_chosen)
+            scores = [len(group) for group in groups]
         else:
             assert self.alt_strategy == 'entity_coverage'
             # Choose the group whose entities cover more text
-            coverages = [sum(len(ent['text']) for ent in group)
-                         for group in groups]
-            N_max = coverages.index(max(coverages))
-            chosen_entities = groups[N_max]
-            group_text = alt_texts[N_max]
-        
-            if sum(coverages) != coverages[N_max]:
-                # More than 2 groups with entities
-                logger.debug('Choosing ALT %s over alternatives %s',
-                             chosen_entities,
-                             groups[:].remove(chosen_entities))
+            scores = [sum(len(ent['text']) for ent in group)
+                      for group in groups]
+
+        # `max` returns the first group with the highest score
+        N_max = max(range(len(groups)), key=scores.__getitem__)
+        chosen_entities = groups[N_max]
+        group_text = alt_texts[N_max]
+
+        if sum(scores) != scores[N_max] \
+                and logger.isEnabledFor(logging.DEBUG):
+            # More than 1 group with entities
+            logger.debug(
+                'Choosing ALT %s over alternatives %s',
+                chosen_entities,
+                groups[:N_max] + groups[N_max + 1:])
         
         return group_text, chosen_entities
 
 
     @staticmethod
-    def _avoid_word_agglutination(text: str, insertion: str) -> str:
+    def _agglutinates(text: str, piece: str) -> bool:
+        """Whether directly appending `piece` to `text` would agglutinate the
+        last word of `text` and the first word of `piece`."""
+        if text and piece and not _WHITESPACE_OR_PUNCTUATION[text[-1]] \
+                and not _WHITESPACE_OR_PUNCTUATION[piece[0]]:
+            if logger.isEnabledFor(logging.DEBUG):
+                left, right = text[-10:], piece[:10]
+                logger.debug('Adding space between "%s%s" -> "%s %s"',
+                             left, right, left, right)
+            return True
+
+        return False
+
+    @classmethod
+    def _avoid_word_agglutination(cls, text: str, insertion: str) -> str:
         """Conditionally inserts one space at the end of `text` to avoid word
         agglutination that would happen by concatenating `text` and `insertion`.
         """
-        if not text:
-            return text
-        
-        if not _is_whitespace_or_punctuation(text[-1]) \
-                and not _is_whitespace_or_punctuation(insertion[0]):
-            logger.debug(
-                'Adding space between "%(0)s%(1)s" -> "%(0)s %(1)s"',
-                text[-10:], insertion[:10])
+        if cls._agglutinates(text, insertion):
             text += ' '
 
         return text
 
-    @staticmethod
-    def append_text_safe(text: str, piece: str) -> str:
+    @classmethod
+    def append_text_safe(cls, text: str, piece: str) -> str:
         """Appends `piece` to `text`, conditionally inserting a space in between
         if directly appending would cause agglutination of the last word of
         `text` and first word of `piece`."""
-
-        if text and not _is_whitespace_or_punctuation(text[-1]) \
-                and not _is_whitespace_or_punctuation(piece[0]):
-            logger.debug(
-                'Adding space between "%(0)s%(1)s" -> "%(0)s %(1)s"',
-                text[-10:], piece[:10])
+        if cls._agglutinates(text, piece):
             text += ' '
         
         return text + piece
 
 
+    def _convert_em_tag(self, tag: etree._Element
+                        ) -> Tuple[str, List[ENTITY]]:
+        """Convert an <EM/> tag into its text and a list with its entity, which
+        is empty if the entity label is not accepted in the label scenario."""
+        entity = self._convert_entity(tag)
+        if entity['label'] is None:
+            return entity['text'], []
+
+        return entity['text'], [entity]
+
     def _convert_tag(self, tag: etree._Element) -> Tuple[str, List[ENTITY]]:
         """Convert a tag to a dictionary with all the relevant info,
         keeping alignment of extracted entities to the original text."""
-        text = ''
-        entities = []
-
-        if tag.tag == 'EM':
-            entity = self._convert_entity(tag)
-            if entity['label'] is not None:
-                entities.append(entity)
-            text = entity['text']
-
-        elif tag.tag == 'ALT':
-            alt_text, alt_entities = self._handle_alt(tag)
-            text = alt_text
-            entities = alt_entities
+        handler = self._tag_handlers.get(tag.tag)
+        if handler is not None:
+            text, entities = handler(tag)
+        else:
+            text = ''
+            entities = []
         
-        if tag.tail is not None:
-            text = self._avoid_word_agglutination(text, tag.tail)
-            text += tag.tail
+        tail = tag.tail
+        if tail is not None:
+            text = self._avoid_word_agglutination(text, tail)
+            text += tail
                 
         return text, entities
 
@@ -306,51 +345,156 @@ class XMLtoJSON:
     def convert_document(self, doc: etree._Element) -> DOCUMENT:
         """Convert DOC tag to a dictionary with all the relevant info."""
         
-        text = ''
+        # Text pieces are joined once at the end to avoid quadratic string
+        # concatenation; `text_len` tracks the length of the joined text
+        parts = []
+        text_len = 0
         entities = []
         
         if doc.tag != 'DOC':
             raise ValueError("`convert_document` expects a DOC tag.")
         
-        if doc.text is not None:
+        doc_text = doc.text
+        if doc_text:
             # Initial text before any tag
-            text += doc.text
+            parts.append(doc_text)
+            text_len += len(doc_text)
         
         for tag in doc:
             tag_text, tag_entities = self._convert_tag(tag)
-            text = self._avoid_word_agglutination(text, tag_text)
+
+            # If last character was not a whitespace or punctuation, add space
+            # to prevent that an entity contains a word only partially
+            if parts and self._agglutinates(parts[-1], tag_text):
+                parts.append(' ')
+                text_len += 1
 
             # Entity start and end offsets are relative to begin of `tag`.
             # Shift tag_entities by current doc text length.
             for entity in tag_entities:
-                self._shift_offset(entity, len(text))
+                entity['start_offset'] += text_len
+                entity['end_offset'] += text_len
 
-            # If last character was not a whitespace or punctuation, add space
-            # to prevent that an entity contains a word only partially
             if tag_text:
-                text = self.append_text_safe(text, tag_text)
+                parts.append(tag_text)
+                text_len += len(tag_text)
             
             entities.extend(tag_entities)
                 
         return {
             'doc_id': doc.attrib['DOCID'],
-            'doc_text': ''.join(text),
+            'doc_text': ''.join(parts),
             'entities': entities,
         }
 
     @classmethod
-    def convert_xml(cls, xml: str, **kwargs) -> List[DOCUMENT]:
+    def convert_xml(cls,
+                    xml: str,
+                    num_workers: int = 1,
+                    **kwargs) -> List[DOCUMENT]:
         """Read a HAREM XML file and convert it to a JSON list according to the
-        chosen label scenario and alt resolution strategy."""
+        chosen label scenario and alt resolution strategy. The file is streamed,
+        so only a few DOCs are held in memory at a time. DOCs are converted
+        in `num_workers` processes if it is greater than 1."""
+        return list(cls.convert_xml_stream(xml, num_workers, **kwargs))
+
+    @classmethod
+    def convert_tree(cls,
+                     docs: Iterable[etree._Element],
+                     **kwargs) -> List[DOCUMENT]:
+        """Convert already parsed DOC tags to a JSON list according to the
+        chosen label scenario and alt resolution strategy. The DOC tags are not
+        modified, so the same tree can be converted in several scenarios."""
         converter = cls(**kwargs)
-        tree = etree.parse(xml)
-        
-        docs = []
-        for doc in tree.findall('//DOC'):
-            doc_info = converter.convert_document(doc)
-            docs.append(doc_info)
-            
-        return docs
+
+        return [converter.convert_document(doc) for doc in docs]
+
+    @classmethod
+    def convert_xml_stream(cls,
+                           xml,
+                           num_workers: int = 1,
+                           **kwargs) -> Iterator[DOCUMENT]:
+        """Stream a HAREM XML file, yielding each DOC converted according to
+        the chosen label scenario and alt resolution strategy.
+
+        DOC tags are cleared and detached from the tree once converted, so
+        memory usage is bounded by a single DOC instead of the whole file.
+
+        If `num_workers` is greater than 1, DOCs are serialized and converted
+        in a pool of `num_workers` processes, in batches of
+        `num_workers * DOCS_PER_WORKER_BATCH` DOCs. Documents are yielded in
+        file order either way."""
+        # Also validates kwargs before any worker is started
+        converter = cls(**kwargs)
+        docs = _iterparse_docs(xml)
+
+        if num_workers <= 1:
+            for doc in docs:
+                yield converter.convert_document(doc)
+            return
+
+        serialized_docs = (etree.tostring(doc, with_tail=False) for doc in docs)
+        batches = _batched(serialized_docs, num_workers * DOCS_PER_WORKER_BATCH)
+
+        with multiprocessing.Pool(num_workers,
+                                  initializer=_init_worker,
+                                  initargs=(cls, kwargs)) as pool:
+            # Parse the next batch in this process while the workers convert
+            # the previous one. lxml trees are only touched by this thread.
+            pending = iter(())
+            for batch in batches:
+                converted = pool.imap(_convert_serialized_doc, batch,
+                                      chunksize=4)
+                yield from pending
+                pending = converted
+            yield from pending
+
+
+# Number of DOCs sent to each worker per batch by `convert_xml_stream`
+DOCS_PER_WORKER_BATCH = 16
+
+# Converter of the current worker process, set by `_init_worker`
+_worker_converter = None
+
+
+def _iterparse_docs(xml) -> Iterator[etree._Element]:
+    """Yield the DOC tags of a HAREM XML file as they are parsed. Each DOC is
+    cleared and detached from the tree once the caller is done with it."""
+    # Every EM tag has an ID attribute, but the ID lookup table that
+    # libxml2 builds for them is never used
+    context = etree.iterparse(xml, events=('end',), tag='DOC',
+                              huge_tree=True, collect_ids=False)
+
+    for _, doc in context:
+        yield doc
+
+        # Free the converted DOC and the already processed siblings
+        doc.clear()
+        while doc.getprevious() is not None:
+            del doc.getparent()[0]
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split `iterable` into lists of `size` items. The last list may be
+    shorter."""
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _init_worker(converter_cls: type, converter_kwargs: dict) -> None:
+    """Build the converter used by a worker process."""
+    global _worker_converter
+    _worker_converter = converter_cls(**converter_kwargs)
+
+
+def _convert_serialized_doc(doc_xml: bytes) -> DOCUMENT:
+    """Parse a serialized DOC tag and convert it in a worker process."""
+    parser = etree.XMLParser(huge_tree=True, collect_ids=False)
+    return _worker_converter.convert_document(
+        etree.fromstring(doc_xml, parser))
 
 
 if __name__ == "__main__":
@@ -371,6 +515,8 @@ if __name__ == "__main__":
                         choices=['most_entities', 'entity_coverage'],
                         default='most_entities',
                         help="ALT tag strategy.")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of processes used to convert documents.')
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite output file.')
     parser.add_argument('--verbose', action='store_true',
@@ -395,9 +541,17 @@ if __name__ == "__main__":
     print('Converting data...')
     converted_data = XMLtoJSON.convert_xml(
         args.input_file,
+        num_workers=args.num_workers,
         selective=args.scenario == 'selective',
         alt_strategy=args.alt_strategy)
 
     print(f'Writing output file to {output_path}')
-    with open(output_path, 'w') as fd:
-        json.dump(converted_data, fd)
\ No newline at end of file
+    try:
+        # Optional faster JSON encoder
+        import orjson
+    except ImportError:
+        with open(output_path, 'w') as fd:
+            json.dump(converted_data, fd)
+    else:
+        with open(output_path, 'wb') as fd:
+            fd.write(orjson.dumps(converted_data))